@@ -1,20 +1,40 @@
-import io
-import os
+import atexit
+import importlib.util
 import json
+import logging
+import os
+import math
+import queue
 import sqlite3
-from datetime import datetime, timezone
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import closing, contextmanager
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Callable
 
 import joblib
-import pandas as pd
+import msgpack
+import numpy as np
 from flask import (
     Flask, request, render_template, flash,
-    redirect, url_for, jsonify, send_file
+    redirect, url_for, jsonify
 )
+from flask.json.provider import DefaultJSONProvider
 from reportlab.lib.pagesizes import letter
 from reportlab.pdfgen import canvas
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 
+try:
+    import orjson
+    _orjson_available = True
+except ImportError:  # stdlib json through Flask's default provider
+    _orjson_available = False
+
 try:
     import arabic_reshaper
     from bidi.algorithm import get_display
@@ -22,6 +42,10 @@ try:
 except ImportError:
     _persian_available = False
 
+# onnxruntime is not fork-safe, so it is only imported inside the worker that
+# actually runs the ONNX graph (see _OnnxPredictor), never at module import.
+_onnx_available = importlib.util.find_spec("onnxruntime") is not None
+
 # =========================
 # Configuration
 # =========================
@@ -35,11 +59,14 @@ def _path_in_app_dir(rel_path: str) -> str:
 
 DB_PATH = "predictions.db"
 MODEL_PATH = "./diabetes_model.pkl"
+# Optional: served through onnxruntime when present (see export_onnx.py)
+ONNX_MODEL_PATH = "./diabetes_model.onnx"
 THRESHOLD = 0.502
 
 # Resolve relative paths from app directory so CWD doesn't matter
 DB_PATH = _path_in_app_dir(DB_PATH)
 MODEL_PATH = _path_in_app_dir(MODEL_PATH)
+ONNX_MODEL_PATH = _path_in_app_dir(ONNX_MODEL_PATH)
 
 # Only the 10 features the model was trained on (exact names/order)
 SELECTED_FEATURES = [
@@ -54,12 +81,66 @@ SELECTED_FEATURES = [
     "Age",
     "BMI",
 ]
+FEATURE_INDEX = {f: i for i, f in enumerate(SELECTED_FEATURES)}
+N_FEATURES = len(SELECTED_FEATURES)
+BMI_INDEX = FEATURE_INDEX["BMI"]
+# Stored input fields, in report order: raw height/weight, then model features
+INPUT_FIELDS = ("height_cm", "weight_kg") + tuple(SELECTED_FEATURES)
+
+
+_json_loads = orjson.loads if _orjson_available else json.loads
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson (jsonify, request.get_json)."""
+
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(
+            obj, default=self.default, option=orjson.OPT_SORT_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        ).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+# =========================
+# Logging
+# =========================
+# Records are queued by the calling thread and written to stderr by a listener
+# thread, so request threads never block on the stream lock.
+_log_handler = QueueHandler(queue.SimpleQueue())
+_log_listener = None
+
+
+def _start_log_listener() -> None:
+    """(Re)start the listener; also run in each forked worker, where threads don't survive."""
+    global _log_listener
+    _log_handler.queue = queue.SimpleQueue()
+    stream = logging.StreamHandler()
+    stream.setFormatter(logging.Formatter("[%(asctime)s] %(levelname)s in %(module)s: %(message)s"))
+    _log_listener = QueueListener(_log_handler.queue, stream)
+    _log_listener.start()
+
+
+_start_log_listener()
+os.register_at_fork(after_in_child=_start_log_listener)
+atexit.register(lambda: _log_listener.stop())  # flush queued records on shutdown
+
+# Same logger as app.logger; having a handler stops Flask adding its own
+logger = logging.getLogger(__name__)
+logger.addHandler(_log_handler)
+logger.setLevel(logging.DEBUG if os.environ.get("FLASK_DEBUG", "0") == "1" else logging.INFO)
+logger.propagate = False
+
 
 # Flask app
 app = Flask(__name__)
+if _orjson_available:
+    app.json = OrjsonProvider(app)
 app.secret_key = os.environ.get("SECRET_KEY", "fallback_random_key_2025")
 
 model = None  # global singleton
+_predict_proba = None  # fn(float64 rows) -> P(diabetes) per row; chosen by load_model
 _model_load_error = None  # last error message when load failed (for 503 message)
 
 
@@ -68,32 +149,100 @@ _model_load_error = None  # last error message when load failed (for 503 message
 # =========================
 def load_model() -> None:
     """Load ML model once (idempotent). Does not raise if file is missing."""
-    global model, _model_load_error
+    global model, _predict_proba, _model_load_error
     if model is not None:
         return
     _model_load_error = None
     if not os.path.isfile(MODEL_PATH):
         _model_load_error = f"Model file not found at {MODEL_PATH}"
-        print(_model_load_error)
+        logger.error(_model_load_error)
         return
     try:
         model = joblib.load(MODEL_PATH)
-        print("Model loaded successfully from", MODEL_PATH)
+        logger.debug("Model loaded from %s", MODEL_PATH)
     except FileNotFoundError:
         _model_load_error = f"Model file not found: {MODEL_PATH}"
-        print(_model_load_error)
+        logger.error(_model_load_error)
     except Exception as e:
         err_msg = str(e).lower()
         _model_load_error = str(e)
-        print(f"Error loading model from {MODEL_PATH}: {e}")
         if "libomp" in err_msg or "lib_lightgbm" in err_msg:
             _model_load_error += " — On macOS run: brew install libomp"
-            print("  -> On macOS, run: brew install libomp")
+        logger.error("Error loading model from %s: %s", MODEL_PATH, _model_load_error)
+    if model is not None:
+        _predict_proba = _make_fast_predict(model)
+        _load_onnx_session()
+        # Never serve scores computed by a previously loaded model
+        _predict_cached.cache_clear()
+
+
+def _make_fast_predict(m):
+    """
+    Return fn(X) -> positive-class probabilities that skips the Pipeline and
+    sklearn-wrapper bookkeeping (input validation, feature-name checks) when
+    that is safe for the loaded estimator; otherwise fall back to predict_proba.
+    """
+    est = m
+    if hasattr(m, "steps"):
+        # Only bypass the pipeline when no step before the estimator transforms X
+        if any(step not in (None, "passthrough") for _, step in m.steps[:-1]):
+            return lambda X: m.predict_proba(X)[:, 1]
+        est = m.steps[-1][1]
+
+    # Imported here, not at module level: a broken LightGBM install (missing
+    # libomp / lib_lightgbm) must surface in load_model as a 503, not at import
+    try:
+        from lightgbm import LGBMClassifier
+    except (ImportError, OSError):
+        LGBMClassifier = None
+
+    if LGBMClassifier is not None and isinstance(est, LGBMClassifier) and est.n_classes_ == 2:
+        # Binary objective: Booster.predict already returns P(y=1)
+        booster, num_iteration = est.booster_, est.best_iteration_ or None
+        return lambda X: booster.predict(X, num_iteration=num_iteration)
+
+    return lambda X: est.predict_proba(X)[:, 1]
 
 
-@app.before_request
-def ensure_model_loaded():
-    load_model()
+class _OnnxPredictor:
+    """
+    Callable running the exported ONNX graph. The session is opened on first
+    use in the process that predicts: with preload_app, load_model runs in the
+    gunicorn master, and onnxruntime state must not be carried across fork().
+    Falls back to the pickled model if the session cannot be opened.
+    """
+
+    def __init__(self, path: str, fallback):
+        self.path = path
+        self.fallback = fallback
+        self._run = None
+
+    def __call__(self, X):
+        if self._run is None:
+            self._run = self._open()
+        return self._run(X)
+
+    def _open(self):
+        try:
+            import onnxruntime as ort
+
+            opts = ort.SessionOptions()
+            opts.intra_op_num_threads = 1  # rows are already batched by _PredictBatcher
+            sess = ort.InferenceSession(
+                self.path, sess_options=opts, providers=["CPUExecutionProvider"]
+            )
+        except Exception as e:
+            logger.warning("Error loading ONNX model from %s, using %s: %s", self.path, MODEL_PATH, e)
+            return self.fallback
+        logger.debug("ONNX model loaded from %s", self.path)
+        return lambda X: sess.run(["probabilities"], {"input": X.astype(np.float32)})[0][:, 1]
+
+
+def _load_onnx_session() -> None:
+    """Use the exported ONNX graph if onnxruntime and the file are present."""
+    global _predict_proba
+    if _onnx_available and os.path.isfile(ONNX_MODEL_PATH):
+        _predict_proba = _OnnxPredictor(ONNX_MODEL_PATH, _predict_proba)
 
 
 def _model_unavailable_response():
@@ -110,63 +259,309 @@ def _model_unavailable_response():
     )
 
 
+# =========================
+# Background batching
+# =========================
+class _BatchWorker(ABC):
+    """Daemon thread that drains a queue of (payload, Future) pairs in batches.
+
+    Each loop takes whatever is already queued (up to max_batch items, for at
+    most max_wait seconds), passes the payloads to handle() and resolves each
+    Future with its result. A lone request is never held back waiting for more.
+    """
+
+    def __init__(self, name: str, max_batch: int, max_wait: float):
+        self.name = name
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @abstractmethod
+    def handle(self, payloads: list) -> list:
+        """Process one batch; return one result per payload, in order."""
+
+    def submit(self, payload) -> Future:
+        self._ensure_started()
+        fut = Future()
+        self._queue.put((payload, fut))
+        return fut
+
+    def _ensure_started(self) -> None:
+        # Started lazily so each (forked) worker process gets its own thread
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            items = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(items) < self.max_batch and time.monotonic() < deadline:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                results = self.handle([payload for payload, _ in items])
+            except Exception as e:
+                for _, fut in items:
+                    fut.set_exception(e)
+                continue
+            for (_, fut), res in zip(items, results):
+                fut.set_result(res)
+
+
 # =========================
 # Database helpers
 # =========================
-def get_conn():
-    # check_same_thread=False helps when using dev server/threading
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
+DB_POOL_SIZE = 8  # read connections per process; matches gunicorn threads so no request waits
+_DB_PRAGMAS = (
+    "PRAGMA page_size=4096",  # only takes effect while the database is still empty
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-20000",  # ~20 MB page cache per connection
+)
+
+# Keep the SQL text identical on every call so each connection's statement
+# cache hands back the already-prepared statement instead of reparsing.
+_INSERT_SQL = "INSERT INTO predictions (created_at, input_blob, prob, result) VALUES (?, ?, ?, ?)"
+_SELECT_SQL = "SELECT id, created_at, input_blob, prob, result FROM predictions WHERE id = ?"
+
+# created_at is stored as integer microseconds since the Unix epoch (UTC)
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def _open_conn() -> sqlite3.Connection:
+    # check_same_thread=False: pooled connections move between request threads.
+    # isolation_level=None: autocommit, no implicit BEGIN/COMMIT per statement.
+    # Rows stay plain tuples: the hot queries read columns by position.
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    for pragma in _DB_PRAGMAS:
+        conn.execute(pragma)
     return conn
 
 
-def init_db() -> None:
-    with get_conn() as conn:
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS predictions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                created_at TEXT NOT NULL,
-                input_json TEXT NOT NULL,
-                prob REAL NOT NULL,
-                result INTEGER NOT NULL
+# Long-lived connections, opened once per process instead of per query. Created
+# lazily: SQLite connections must not cross fork(), and with preload_app the
+# module is imported in the gunicorn master before the workers are forked.
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def _get_pool() -> queue.Queue:
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                pool = queue.Queue()
+                for _ in range(DB_POOL_SIZE):
+                    pool.put(_open_conn())
+                _POOL = pool
+    return _POOL
+
+
+@contextmanager
+def get_conn():
+    """Borrow a pooled connection for the duration of the with-block."""
+    pool = _get_pool()
+    conn = pool.get()
+    try:
+        yield conn
+    finally:
+        pool.put(conn)
+
+
+def _optimize_db() -> None:
+    """On exit, let SQLite refresh planner statistics on the idle pooled connections."""
+    if _POOL is None:
+        return
+    while True:
+        try:
+            conn = _POOL.get_nowait()
+        except queue.Empty:
+            return
+        try:
+            conn.execute("PRAGMA optimize")  # usually a no-op
+        except sqlite3.Error:
+            pass
+        finally:
+            conn.close()
+
+
+atexit.register(_optimize_db)
+
+
+_SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        created_at INTEGER NOT NULL,
+        input_blob BLOB NOT NULL,
+        prob REAL NOT NULL,
+        result INTEGER NOT NULL
+    )
+"""
+
+# Nothing queries these yet; they exist so date-range and positives-only
+# listings start out as index lookups instead of full scans
+_INDEX_SQL = (
+    "CREATE INDEX IF NOT EXISTS idx_predictions_created_at ON predictions (created_at DESC)",
+    "CREATE INDEX IF NOT EXISTS idx_predictions_result ON predictions (result)",
+)
+
+
+def _to_epoch_us(dt: datetime) -> int:
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return (dt - _EPOCH) // timedelta(microseconds=1)
+
+
+def _from_epoch_us(us: int) -> datetime:
+    return _EPOCH + timedelta(microseconds=us)
+
+
+def _migrate_legacy_table(conn) -> None:
+    """
+    Rewrite a predictions table from the old layout (ISO text created_at,
+    JSON input_json) to integer microseconds + msgpack, keeping ids.
+    Runs inside an IMMEDIATE transaction so concurrent workers migrate once.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        cols = {r["name"] for r in conn.execute("PRAGMA table_info(predictions)")}
+        if "input_json" in cols:
+            conn.execute(_SCHEMA_SQL.format(table="predictions_new"))
+            rows = conn.execute(
+                "SELECT id, created_at, input_json, prob, result FROM predictions"
+            ).fetchall()
+            migrated = []
+            for r in rows:
+                try:
+                    created_us = _to_epoch_us(datetime.fromisoformat(r["created_at"]))
+                except (TypeError, ValueError):
+                    created_us = 0
+                inputs = _json_loads(r["input_json"]) if r["input_json"] else {}
+                migrated.append(
+                    (r["id"], created_us, msgpack.packb(inputs), r["prob"], r["result"])
+                )
+            conn.executemany(
+                "INSERT INTO predictions_new (id, created_at, input_blob, prob, result) "
+                "VALUES (?, ?, ?, ?, ?)",
+                migrated,
             )
-            """
-        )
-        conn.commit()
+            # Keep AUTOINCREMENT from reusing ids of rows deleted before the migration
+            last_seq = conn.execute(
+                "SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence WHERE name = 'predictions'"
+            ).fetchone()[0]
+            conn.execute("DROP TABLE predictions")
+            conn.execute("ALTER TABLE predictions_new RENAME TO predictions")
+            conn.execute("DELETE FROM sqlite_sequence WHERE name = 'predictions'")
+            conn.execute(
+                "INSERT INTO sqlite_sequence (name, seq) "
+                "SELECT 'predictions', MAX(?, COALESCE(MAX(id), 0)) FROM predictions",
+                (last_seq,),
+            )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def init_db() -> None:
+    # Own short-lived connection, closed before any worker is forked
+    with closing(_open_conn()) as conn:
+        conn.row_factory = sqlite3.Row  # the one-off migration reads by name
+        conn.execute(_SCHEMA_SQL.format(table="predictions"))
+        _migrate_legacy_table(conn)
+        for sql in _INDEX_SQL:
+            conn.execute(sql)
+
+
+WRITE_MAX_BATCH = 500
+WRITE_MAX_WAIT = 0.05  # seconds
+WRITE_TIMEOUT = 5.0
+
+
+class _RecordWriter(_BatchWorker):
+    """
+    Group-commit prediction INSERTs: one transaction (one fsync) per batch.
+    The writer thread is the process's only writer and keeps its own
+    connection, so writes never wait on the read pool and need no lock.
+    """
+
+    _conn = None
+
+    def handle(self, rows: list) -> list:
+        if self._conn is None:
+            # Opened in the writer thread itself, i.e. after any fork
+            self._conn = _open_conn()
+            # Larger page cache than the readers: every batch appends to
+            # the right-most leaf of the table B-tree and rewrites its parents
+            self._conn.execute("PRAGMA cache_size=-64000")
+        conn = self._conn
+        # IMMEDIATE takes the write lock up front, so no other process can
+        # interleave rows and the AUTOINCREMENT ids of this batch are contiguous
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(_INSERT_SQL, rows)
+            last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return list(range(last_id - len(rows) + 1, last_id + 1))
+
+
+_writer = _RecordWriter("record-writer", WRITE_MAX_BATCH, WRITE_MAX_WAIT)
 
 
 def save_record(input_dict: dict, prob: float, result: int) -> int:
-    created_at = datetime.now(timezone.utc).isoformat()
-    payload = json.dumps(input_dict, ensure_ascii=False)
-    with get_conn() as conn:
-        cur = conn.execute(
-            "INSERT INTO predictions (created_at, input_json, prob, result) VALUES (?, ?, ?, ?)",
-            (created_at, payload, float(prob), int(result)),
-        )
-        conn.commit()
-        return int(cur.lastrowid)
+    """Queue the record on the background writer; returns its id once committed."""
+    created_at = time.time_ns() // 1000
+    row = (created_at, msgpack.packb(input_dict), float(prob), int(result))
+    return _writer.submit(row).result(timeout=WRITE_TIMEOUT)
 
 
 def get_record(rec_id: int):
     with get_conn() as conn:
-        row = conn.execute(
-            "SELECT id, created_at, input_json, prob, result FROM predictions WHERE id = ?",
-            (rec_id,),
-        ).fetchone()
+        row = conn.execute(_SELECT_SQL, (rec_id,)).fetchone()
 
-    if not row:
+    if row is None:
         return None
 
+    # Columns in _SELECT_SQL order; SQLite already returns INTEGER/REAL as int/float
     return {
-        "id": int(row["id"]),
-        "created_at": row["created_at"],
-        "input": json.loads(row["input_json"]),
-        "prob": float(row["prob"]),
-        "result": int(row["result"]),
+        "id": row[0],
+        "created_at": _from_epoch_us(row[1]).isoformat(),
+        "input": msgpack.unpackb(row[2]),
+        "prob": row[3],
+        "result": row[4],
     }
 
 
+RECORD_CACHE_SIZE = 1024
+
+
+@lru_cache(maxsize=RECORD_CACHE_SIZE)
+def _get_record_cached(rec_id: int) -> dict:
+    """get_record for the read routes. Records never change once written, so
+    hits skip SQLite. The dict is shared between callers: treat it as read-only.
+
+    Raises KeyError for unknown ids (exceptions are not cached, so an id that
+    is looked up before its record is written is not remembered as missing).
+    """
+    rec = get_record(rec_id)
+    if rec is None:
+        raise KeyError(rec_id)
+    return rec
+
+
 # Initialize DB at import time
 init_db()
 
@@ -174,84 +569,165 @@ init_db()
 # =========================
 # Input validation & parsing
 # =========================
-def _get_value(src, key: str):
-    # Works for request.form (MultiDict) and JSON dict
-    if src is None:
-        return None
-    return src.get(key)
+def _to_int(raw) -> int:
+    # allow "1.0" but store as int
+    return int(float(raw))
+
+
+# (field, caster, low, high, range error, model row index) in input order;
+# height/weight first (not model features: index None), then every model
+# feature except the derived BMI. Unbounded fields have no error.
+VALIDATORS = tuple(
+    (name, cast, lo, hi, err, FEATURE_INDEX.get(name))
+    for name, cast, lo, hi, err in (
+        ("height_cm", float, 90, 230, "قد باید بین ۹۰ تا ۲۳۰ سانتی‌متر باشد"),
+        ("weight_kg", float, 25, 220, "وزن باید بین ۲۵ تا ۲۲۰ کیلوگرم باشد"),
+        ("HighBP", _to_int, -math.inf, math.inf, None),
+        ("HighChol", _to_int, -math.inf, math.inf, None),
+        ("GenHlth", _to_int, 1, 5, "سلامت عمومی باید بین ۱ (عالی) تا ۵ (ضعیف) باشد"),
+        ("PhysHlth", _to_int, 0, 30, "PhysHlth باید بین ۰ تا ۳۰ باشد"),
+        ("DiffWalk", _to_int, -math.inf, math.inf, None),
+        ("HeartDiseaseorAttack", _to_int, -math.inf, math.inf, None),
+        ("PhysActivity", _to_int, -math.inf, math.inf, None),
+        ("Gender", _to_int, -math.inf, math.inf, None),
+        ("Age", _to_int, 1, 13, "گروه سنی باید بین ۱ تا ۱۳ باشد (طبق دسته‌بندی BRFSS)"),
+    )
+)
+
+# Fresh model row (SELECTED_FEATURES order), filled in by _validate_inputs
+_ROW_TEMPLATE = np.full(N_FEATURES, np.nan)
+
+
+def _build_validate_inputs():
+    """
+    Generate the per-field pass of parse_and_validate from VALIDATORS: one
+    straight-line block per field with its name, caster, row index and
+    bounds baked in, instead of a loop that unpacks a table row and
+    dispatches through the caster on every field of every request.
+    Unbounded fields (no range error) get no range check at all.
+    """
+    casts = {float: "float(raw)", _to_int: "int(float(raw))"}
+    lines = [
+        "def _validate_inputs(src, row, errors):",
+        "    data = {}",
+        "    get = src.get if src is not None else _no_value",
+    ]
+    for i, (field, cast, lo, hi, err, idx) in enumerate(VALIDATORS):
+        store = f"data[{field!r}] = val" if idx is None else f"data[{field!r}] = row[{idx}] = val"
+        lines += [
+            f"    raw = get({field!r})",
+            "    if raw is None or str(raw).strip() == '':",
+            f"        errors.append('فیلد اجباری وارد نشده است: ' + {field!r})",
+            "    else:",
+            # Kept per field so one bad value doesn't hide errors in the others
+            "        try:",
+            f"            val = {casts.get(cast, f'_cast{i}(raw)')}",
+            "        except (ValueError, TypeError):",
+            f"            errors.append(f'مقدار نامعتبر برای {field}: {{raw}}')",
+            "        else:",
+            f"            {store}",
+        ]
+        if err is not None:
+            # "not (...)" rather than "<"/">" so NaN fails the check too
+            lines += [
+                f"            if not ({lo!r} <= val <= {hi!r}):",
+                f"                errors.append({err!r})",
+            ]
+    lines.append("    return data")
+
+    namespace = {"_no_value": lambda key: None}
+    namespace.update((f"_cast{i}", v[1]) for i, v in enumerate(VALIDATORS))
+    exec(compile("\n".join(lines), "<_validate_inputs>", "exec"), namespace)
+    return namespace["_validate_inputs"]
+
+
+_validate_inputs = _build_validate_inputs()
 
 
 def parse_and_validate(form_or_json, source: str = "form"):
     """
     Validates user inputs, computes BMI, and returns:
-      (True, {"data": <dict>, "row": <pd.DataFrame>})
+      (True, {"data": <dict>, "row": <np.ndarray>, "key": <bytes>})
       (False, {"errors": [..]})
     """
-    data = {}
     errors = []
+    row = _ROW_TEMPLATE.copy()
+    data = _validate_inputs(form_or_json, row, errors)
+    if errors:
+        return False, {"errors": errors}
 
-    required_fields = ["height_cm", "weight_kg"] + [
-        f for f in SELECTED_FEATURES if f != "BMI"
-    ]
+    # Height and weight have passed their range checks, so height is > 0 here
+    height_m = data["height_cm"] / 100.0
+    bmi = round(data["weight_kg"] / (height_m ** 2), 1)
+    if bmi < 10 or bmi > 80:
+        return False, {"errors": [f"BMI محاسبه شده غیرمنطقی است: {bmi:.1f}"]}
+    data["BMI"] = bmi
+    row[BMI_INDEX] = bmi
 
-    for field in required_fields:
-        raw = _get_value(form_or_json, field)
+    # The row's raw bytes double as a hashable prediction cache key
+    return True, {"data": data, "row": row, "key": row.tobytes()}
 
-        if raw is None or str(raw).strip() == "":
-            errors.append(f"فیلد اجباری وارد نشده است: {field}")
-            continue
 
-        try:
-            if field in ("height_cm", "weight_kg"):
-                val = float(raw)
-            else:
-                # allow "1.0" but store as int
-                val = int(float(raw))
-
-            # Range checks
-            if field == "height_cm" and not (90 <= val <= 230):
-                errors.append("قد باید بین ۹۰ تا ۲۳۰ سانتی‌متر باشد")
-            elif field == "weight_kg" and not (25 <= val <= 220):
-                errors.append("وزن باید بین ۲۵ تا ۲۲۰ کیلوگرم باشد")
-            elif field == "Age" and not (1 <= val <= 13):
-                errors.append("گروه سنی باید بین ۱ تا ۱۳ باشد (طبق دسته‌بندی BRFSS)")
-            elif field == "GenHlth" and not (1 <= val <= 5):
-                errors.append("سلامت عمومی باید بین ۱ (عالی) تا ۵ (ضعیف) باشد")
-            elif field == "PhysHlth" and not (0 <= val <= 30):
-                errors.append("PhysHlth باید بین ۰ تا ۳۰ باشد")
-
-            data[field] = val
-
-        except (ValueError, TypeError):
-            errors.append(f"مقدار نامعتبر برای {field}: {raw}")
+# =========================
+# Prediction
+# =========================
+PREDICT_MAX_BATCH = 64
+PREDICT_MAX_WAIT = 0.005  # seconds
+PREDICT_TIMEOUT = 2.0
 
-    if errors:
-        return False, {"errors": errors}
 
-    # Compute BMI
-    try:
-        height_m = data["height_cm"] / 100.0
-        if height_m <= 0:
-            raise ValueError("قد نمی‌تواند صفر یا منفی باشد")
+class _PredictBatcher(_BatchWorker):
+    """Coalesce concurrent single-row predictions into one model call.
 
-        bmi = data["weight_kg"] / (height_m ** 2)
-        bmi = round(float(bmi), 1)
+    Feature keys from many request threads become the rows of one array, so
+    _predict_proba (LightGBM booster_.predict, the ONNX session, or whatever
+    load_model picked) is entered once per batch: its fixed per-call cost,
+    including the GIL release/reacquire around the native code, is paid once
+    instead of per request.
+    """
 
-        if bmi < 10 or bmi > 80:
-            return False, {"errors": [f"BMI محاسبه شده غیرمنطقی است: {bmi:.1f}"]}
+    def handle(self, keys: list) -> list:
+        # Keys are raw float64 rows, so the batch is one C-contiguous buffer.
+        # float64 keeps results identical to the DataFrame path (LightGBM split
+        # thresholds are doubles; float32 rounding of BMI could flip a split).
+        arr = np.frombuffer(b"".join(keys), dtype=np.float64).reshape(len(keys), N_FEATURES)
+        return [float(p) for p in _predict_proba(arr)]
 
-        data["BMI"] = bmi
-    except Exception as e:
-        return False, {"errors": [f"خطا در محاسبه BMI: {str(e)}"]}
 
-    # Prepare row for model (exact columns)
-    try:
-        row_dict = {f: data[f] for f in SELECTED_FEATURES}
-        row = pd.DataFrame([row_dict], columns=SELECTED_FEATURES)
-    except Exception as e:
-        return False, {"errors": [f"خطا در آماده‌سازی داده برای مدل: {str(e)}"]}
+_batcher = _PredictBatcher("predict-batcher", PREDICT_MAX_BATCH, PREDICT_MAX_WAIT)
 
-    return True, {"data": data, "row": row}
+
+@lru_cache(maxsize=65536)
+def _predict_cached(key: bytes) -> float:
+    """Positive-class probability for one model row (float64 bytes, SELECTED_FEATURES order).
+
+    The inputs are low-cardinality, so repeated submissions are common and a
+    cache hit skips the model entirely; misses go through the micro-batcher.
+    """
+    return _batcher.submit(key).result(timeout=PREDICT_TIMEOUT)
+
+
+# Load at import: under gunicorn's preload_app this happens once in the master
+# and the forked workers share the model's memory pages copy-on-write.
+load_model()
+
+
+# =========================
+# Date helpers
+# =========================
+@lru_cache(maxsize=4)
+def _local_date(ts_sec: int, fmt: str) -> str:
+    return datetime.fromtimestamp(ts_sec).strftime(fmt)
+
+
+def today_str() -> str:
+    """Local date as YYYY-MM-DD; formatted at most once per second."""
+    return _local_date(int(time.time()), "%Y-%m-%d")
+
+
+def today_compact() -> str:
+    """Local date as YYYYMMDD; formatted at most once per second."""
+    return _local_date(int(time.time()), "%Y%m%d")
 
 
 # =========================
@@ -260,6 +736,8 @@ def parse_and_validate(form_or_json, source: str = "form"):
 @app.route("/", methods=["GET", "POST"])
 def index():
     if request.method == "POST":
+        if model is None:
+            load_model()  # retry, in case the model file appeared after startup
         if model is None:
             return _model_unavailable_response()
         valid, payload = parse_and_validate(request.form, source="form")
@@ -268,10 +746,9 @@ def index():
                 flash(err, "danger")
             return redirect(url_for("index"))
 
-        row = payload["row"]
         user_data = payload["data"]
 
-        prob = float(model.predict_proba(row)[0][1])
+        prob = _predict_cached(payload["key"])
         result = int(prob > THRESHOLD)
 
         rec_id = save_record(user_data, prob, result)
@@ -282,7 +759,7 @@ def index():
                 "result": result,
                 "prob": f"{prob:.1%}",
                 "id": rec_id,
-                "date": datetime.now().strftime("%Y-%m-%d"),
+                "date": today_str(),
             },
         )
 
@@ -291,6 +768,8 @@ def index():
 
 @app.route("/api/predict", methods=["POST"])
 def api_predict():
+    if model is None:
+        load_model()  # retry, in case the model file appeared after startup
     if model is None:
         err = _model_load_error or f"Ensure diabetes_model.pkl exists or set MODEL_PATH. Path used: {MODEL_PATH}"
         return jsonify({"error": "Model not available. " + err}), 503
@@ -301,10 +780,9 @@ def api_predict():
     if not valid:
         return jsonify({"errors": payload["errors"]}), 400
 
-    row = payload["row"]
     user_data = payload["data"]
 
-    prob = float(model.predict_proba(row)[0][1])
+    prob = _predict_cached(payload["key"])
     result = int(prob > THRESHOLD)
     rec_id = save_record(user_data, prob, result)
 
@@ -323,14 +801,10 @@ def api_predict():
 # PDF helpers (Persian / RTL)
 # =========================
 _PDF_FONT_NAME = None
-# Fallback download URL for Vazirmatn (single TTF, no zip)
-VAZIRMATN_REGULAR_URL = (
-    "https://github.com/rastikerdar/vazirmatn/raw/master/fonts/ttf/Vazirmatn-Regular.ttf"
-)
 
 
 def _register_pdf_font():
-    """Register a Persian-capable font. Use Vazirmatn (local or auto-download) or Windows Tahoma/Arial."""
+    """Register a Persian-capable font: the bundled Vazirmatn, else Windows Tahoma/Arial, else Helvetica."""
     global _PDF_FONT_NAME
     if _PDF_FONT_NAME:
         return _PDF_FONT_NAME
@@ -347,7 +821,7 @@ def _register_pdf_font():
         except Exception:
             return False
 
-    # 1) Prefer local Vazirmatn
+    # 1) Prefer the bundled Vazirmatn (static/fonts, shipped with the repo)
     if try_register(vazir_path, "Vazirmatn"):
         _PDF_FONT_NAME = "Vazirmatn"
         return _PDF_FONT_NAME
@@ -365,28 +839,19 @@ def _register_pdf_font():
                             _PDF_FONT_NAME = name
                             return _PDF_FONT_NAME
 
-    # 3) Auto-download Vazirmatn to static/fonts and use it
-    import urllib.request
-    for url in (
-        VAZIRMATN_REGULAR_URL,
-        "https://cdn.jsdelivr.net/gh/rastikerdar/vazirmatn@master/fonts/ttf/Vazirmatn-Regular.ttf",
-    ):
-        try:
-            os.makedirs(fonts_dir, exist_ok=True)
-            urllib.request.urlretrieve(url, vazir_path)
-            if os.path.isfile(vazir_path) and try_register(vazir_path, "Vazirmatn"):
-                _PDF_FONT_NAME = "Vazirmatn"
-                return _PDF_FONT_NAME
-        except Exception as e:
-            print(f"Could not download Persian font from {url[:50]}...: {e}")
-            continue
-
+    # 3) No Persian-capable font: Persian text will not render, but the report still does
+    logger.warning("No Persian font found (expected %s); falling back to Helvetica", vazir_path)
     _PDF_FONT_NAME = "Helvetica"
     return _PDF_FONT_NAME
 
 
 def _persian_pdf(text: str) -> str:
-    """Reshape and bidi for Persian/Arabic so it displays correctly in PDF."""
+    """
+    Reshape and bidi for Persian/Arabic so it displays correctly in PDF.
+    Not memoized: the fixed text is shaped once into the _PDF_*_RTL tables
+    below, and the remaining per-report lines (number, timestamp,
+    probability) rarely repeat, while each record's PDF is cached whole.
+    """
     if not text or not _persian_available:
         return text
     try:
@@ -396,38 +861,81 @@ def _persian_pdf(text: str) -> str:
         return text
 
 
-def _pdf_draw_rtl(c, x_right, y, text, font_name, size):
+def _pdf_draw_rtl_raw(c, x_right, y, shaped, font_name, size):
+    """Draw text that has already been through _persian_pdf."""
     c.setFont(font_name, size)
-    c.drawRightString(x_right, y, _persian_pdf(text))
+    c.drawRightString(x_right, y, shaped)
 
 
-def _pdf_draw_centred(c, x_center, y, text, font_name, size):
+def _pdf_draw_centred_raw(c, x_center, y, shaped, font_name, size):
+    """Draw text that has already been through _persian_pdf, centred on x_center."""
     c.setFont(font_name, size)
-    s = _persian_pdf(text)
-    w = c.stringWidth(s, font_name, size)
-    c.drawString(x_center - w / 2, y, s)
+    w = c.stringWidth(shaped, font_name, size)
+    c.drawString(x_center - w / 2, y, shaped)
 
 
-@app.route("/download/<int:rec_id>")
-def download_pdf(rec_id: int):
-    rec = get_record(rec_id)
-    if not rec:
-        return "Record not found", 404
-
-    buffer = io.BytesIO()
-    p = canvas.Canvas(buffer, pagesize=letter)
+def _pdf_draw_rtl(c, x_right, y, text, font_name, size):
+    _pdf_draw_rtl_raw(c, x_right, y, _persian_pdf(text), font_name, size)
+
+
+# Labels for the "your answers" section of the report
+PDF_LABELS = {
+    "height_cm": "قد (سانتی‌متر)",
+    "weight_kg": "وزن (کیلوگرم)",
+    "HighBP": "فشار خون بالا",
+    "HighChol": "کلسترول بالا",
+    "GenHlth": "سلامت عمومی (۱=عالی ... ۵=ضعیف)",
+    "PhysHlth": "روزهای سلامت جسمی ضعیف (۳۰ روز اخیر)",
+    "DiffWalk": "مشکل در راه رفتن",
+    "HeartDiseaseorAttack": "سابقه بیماری قلبی یا حمله قلبی",
+    "PhysActivity": "فعالیت بدنی منظم",
+    "Gender": "جنسیت (۰=زن، ۱=مرد)",
+    "Age": "گروه سنی",
+    "BMI": "شاخص توده بدنی (محاسبه شده)",
+}
+
+# Fixed report text, kept here so it can be pre-shaped along with the labels
+PDF_TEXT = {
+    "title": "گزارش ارزیابی خطر دیابت",
+    "subtitle": "پیش‌بینی خطر دیابت نوع ۲",
+    "details": "جزئیات گزارش",
+    "answers": "پاسخ‌های شما",
+    "high": "خطر بالا",
+    "low": "خطر پایین",
+    "footer": "این ابزار فقط برای غربالگری است • تشخیص پزشکی نیست • با پزشک مشورت کنید",
+}
+
+# How each stored input value is printed in the report
+PDF_FORMATTERS: dict[str, Callable[[Any], str]] = {k: str for k in INPUT_FIELDS}
+PDF_FORMATTERS["BMI"] = lambda v: f"{v:.1f}"
+
+# Register the font and shape the fixed text once at import; _render_pdf draws
+# these directly and only passes per-report strings through _persian_pdf
+_register_pdf_font()
+_PDF_LABELS_RTL = {k: _persian_pdf(f"• {v}") for k, v in PDF_LABELS.items()}
+_PDF_TEXT_RTL = {k: _persian_pdf(v) for k, v in PDF_TEXT.items()}
+_PDF_VERDICT_RTL = {
+    1: (_PDF_TEXT_RTL["high"], _persian_pdf(f"نتیجه: {PDF_TEXT['high']}")),
+    0: (_PDF_TEXT_RTL["low"], _persian_pdf(f"نتیجه: {PDF_TEXT['low']}")),
+}
+
+
+def _draw_pdf(rec: dict) -> bytes:
+    """Draw the report for a record (as returned by get_record) into PDF bytes."""
+    # No file object: getpdfdata() below hands back the document bytes directly
+    p = canvas.Canvas(None, pagesize=letter)
     width, height = letter
     right = width - 50
     font_name = _register_pdf_font()
 
     # Header
     p.setFillColorRGB(0.1, 0.5, 0.7)
-    _pdf_draw_centred(p, width / 2, height - 70, "گزارش ارزیابی خطر دیابت", font_name, 20)
-    _pdf_draw_centred(p, width / 2, height - 100, "پیش‌بینی خطر دیابت نوع ۲", font_name, 12)
+    _pdf_draw_centred_raw(p, width / 2, height - 70, _PDF_TEXT_RTL["title"], font_name, 20)
+    _pdf_draw_centred_raw(p, width / 2, height - 100, _PDF_TEXT_RTL["subtitle"], font_name, 12)
 
     # Report details (RTL)
     p.setFillColorRGB(0, 0, 0)
-    _pdf_draw_rtl(p, right, height - 140, "جزئیات گزارش", font_name, 14)
+    _pdf_draw_rtl_raw(p, right, height - 140, _PDF_TEXT_RTL["details"], font_name, 14)
     _pdf_draw_rtl(p, right, height - 165, f"شماره گزارش: {rec['id']}", font_name, 11)
 
     try:
@@ -438,11 +946,8 @@ def download_pdf(rec_id: int):
 
     _pdf_draw_rtl(p, right, height - 185, f"تاریخ: {created_str}", font_name, 11)
     _pdf_draw_rtl(p, right, height - 205, f"احتمال خطر: {rec['prob']:.1%}", font_name, 11)
-    _pdf_draw_rtl(
-        p, right, height - 225,
-        f"نتیجه: {'خطر بالا' if rec['result'] == 1 else 'خطر پایین'}",
-        font_name, 11,
-    )
+    verdict, verdict_line = _PDF_VERDICT_RTL[1 if rec["result"] == 1 else 0]
+    _pdf_draw_rtl_raw(p, right, height - 225, verdict_line, font_name, 11)
 
     # Risk box
     if rec["result"] == 1:
@@ -451,39 +956,20 @@ def download_pdf(rec_id: int):
         p.setFillColorRGB(0.3, 0.8, 0.4)
     p.rect(380, height - 240, 160, 50, fill=1, stroke=0)
     p.setFillColorRGB(1, 1, 1)
-    _pdf_draw_centred(p, 460, height - 220, "خطر بالا" if rec["result"] == 1 else "خطر پایین", font_name, 16)
+    _pdf_draw_centred_raw(p, 460, height - 220, verdict, font_name, 16)
 
     # User inputs
     p.setFillColorRGB(0, 0, 0)
-    _pdf_draw_rtl(p, right, height - 290, "پاسخ‌های شما", font_name, 13)
+    _pdf_draw_rtl_raw(p, right, height - 290, _PDF_TEXT_RTL["answers"], font_name, 13)
 
     y = height - 320
-    readable_names = {
-        "height_cm": "قد (سانتی‌متر)",
-        "weight_kg": "وزن (کیلوگرم)",
-        "HighBP": "فشار خون بالا",
-        "HighChol": "کلسترول بالا",
-        "GenHlth": "سلامت عمومی (۱=عالی ... ۵=ضعیف)",
-        "PhysHlth": "روزهای سلامت جسمی ضعیف (۳۰ روز اخیر)",
-        "DiffWalk": "مشکل در راه رفتن",
-        "HeartDiseaseorAttack": "سابقه بیماری قلبی یا حمله قلبی",
-        "PhysActivity": "فعالیت بدنی منظم",
-        "Gender": "جنسیت (۰=زن، ۱=مرد)",
-        "Age": "گروه سنی",
-        "BMI": "شاخص توده بدنی (محاسبه شده)",
-    }
     input_data = rec["input"]
 
-    for key in ["height_cm", "weight_kg"] + SELECTED_FEATURES:
+    for key in INPUT_FIELDS:
         if key not in input_data:
             continue
-        label = readable_names.get(key, key)
-        value = input_data[key]
-        if isinstance(value, float) and key in ("BMI",):
-            value_str = f"{value:.1f}"
-        else:
-            value_str = str(value)
-        _pdf_draw_rtl(p, right, y, f"• {label}", font_name, 11)
+        value_str = PDF_FORMATTERS[key](input_data[key])
+        _pdf_draw_rtl_raw(p, right, y, _PDF_LABELS_RTL[key], font_name, 11)
         p.setFont(font_name, 11)
         p.drawString(320, y, value_str)
         y -= 22
@@ -493,33 +979,76 @@ def download_pdf(rec_id: int):
 
     # Footer
     p.setFillColorRGB(0.5, 0.5, 0.5)
-    _pdf_draw_centred(
-        p, width / 2, 30,
-        "این ابزار فقط برای غربالگری است • تشخیص پزشکی نیست • با پزشک مشورت کنید",
-        font_name, 9,
-    )
+    _pdf_draw_centred_raw(p, width / 2, 30, _PDF_TEXT_RTL["footer"], font_name, 9)
 
-    p.save()
-    buffer.seek(0)
+    return p.getpdfdata()
 
-    filename = f"diabetes_risk_report_{rec['id']}_{datetime.now().strftime('%Y%m%d')}.pdf"
-    return send_file(
-        buffer,
-        as_attachment=True,
-        download_name=filename,
-        mimetype="application/pdf",
-    )
+
+# Ids restart whenever the database is recreated (e.g. a fresh deploy), so a
+# client must revalidate every time; a matching tag still skips the render.
+PDF_CACHE_CONTROL = "private, no-cache"
+
+# ReportLab is pure Python and holds the GIL while drawing, so a burst of
+# downloads on every request thread would starve /api/predict. Rendering
+# goes through a small pool instead, capping it per process. The executor
+# only starts its threads on the first submit, i.e. inside the worker.
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS", 2))
+_PDF_POOL = ThreadPoolExecutor(max_workers=PDF_WORKERS, thread_name_prefix="pdf")
+
+PDF_CACHE_SIZE = 1024
+
+
+@lru_cache(maxsize=PDF_CACHE_SIZE)
+def _render_pdf(rec_id: int) -> bytes:
+    """Render the report for a record. Records are immutable, so the bytes are cached.
+
+    Only misses go through _PDF_POOL, so a repeat download never queues
+    behind cold renders. Raises KeyError for unknown ids (exceptions are not
+    cached, so a later record with that id still renders).
+    """
+    rec = _get_record_cached(rec_id)
+    return _PDF_POOL.submit(_draw_pdf, rec).result()
+
+
+@app.route("/download/<int:rec_id>")
+def download_pdf(rec_id: int):
+    # Existence first, so no validator (not even "*") can 304 a missing record
+    try:
+        rec = _get_record_cached(rec_id)
+    except KeyError:
+        return "Record not found", 404
+
+    # The creation time tells apart records that reuse an id after the database
+    # was recreated. Weak: the bytes embed a render timestamp, the content doesn't.
+    created_us = _to_epoch_us(datetime.fromisoformat(rec["created_at"]))
+    etag = f"rec-{rec_id}-{created_us}"
+    if request.if_none_match.contains_weak(etag):
+        resp = app.response_class(status=304)
+    else:
+        data = _render_pdf(rec_id)
+
+        filename = f"diabetes_risk_report_{rec_id}_{today_compact()}.pdf"
+        # The cached bytes are the body as they are: no file wrapper to read
+        # them back out of in 8 KB chunks, one write to the socket
+        resp = app.response_class(data, mimetype="application/pdf")
+        resp.headers.set("Content-Disposition", "attachment", filename=filename)
+        resp.make_conditional(request, accept_ranges=True, complete_length=len(data))
+    resp.set_etag(etag, weak=True)
+    resp.headers["Cache-Control"] = PDF_CACHE_CONTROL
+    return resp
 
 
 @app.route("/record/<int:rec_id>")
 def view_record(rec_id: int):
-    rec = get_record(rec_id)
-    if not rec:
+    try:
+        rec = _get_record_cached(rec_id)
+    except KeyError:
         return jsonify({"error": "Not found"}), 404
     return jsonify(rec)
 
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5003))
-    debug = os.environ.get("FLASK_DEBUG", "1") == "1"
-    app.run(host="0.0.0.0", port=port, debug=debug)
+    # Dev server only; production runs under gunicorn (see Procfile)
+    debug = os.environ.get("FLASK_DEBUG", "0") == "1"
+    app.run(host="0.0.0.0", port=port, debug=debug, threaded=True)
@@ -0,0 +1,44 @@
+"""
+Export diabetes_model.pkl to ONNX for the optional onnxruntime backend in app.py.
+
+    pip install skl2onnx onnxmltools onnxruntime
+    python export_onnx.py [diabetes_model.pkl] [diabetes_model.onnx]
+
+The graph takes a float32 "input" tensor of shape (N, 10) in the same column
+order app.py feeds the pickled model (SELECTED_FEATURES) and returns
+"probabilities" of shape (N, 2). Tree thresholds become float32 in ONNX, so
+probabilities can differ from LightGBM in the 7th decimal place.
+"""
+import sys
+
+import joblib
+from lightgbm import LGBMClassifier
+from onnxmltools.convert.lightgbm.operator_converters.LightGbm import convert_lightgbm
+from skl2onnx import convert_sklearn, update_registered_converter
+from skl2onnx.common.data_types import FloatTensorType
+from skl2onnx.common.shape_calculator import calculate_linear_classifier_output_shapes
+
+
+def main(src: str = "diabetes_model.pkl", dst: str = "diabetes_model.onnx") -> None:
+    update_registered_converter(
+        LGBMClassifier,
+        "LightGbmLGBMClassifier",
+        calculate_linear_classifier_output_shapes,
+        convert_lightgbm,
+        options={"nocl": [True, False], "zipmap": [True, False, "columns"]},
+    )
+    model = joblib.load(src)
+    onx = convert_sklearn(
+        model,
+        "diabetes",
+        [("input", FloatTensorType([None, model.n_features_in_]))],
+        options={LGBMClassifier: {"zipmap": False}},
+        target_opset={"": 17, "ai.onnx.ml": 3},
+    )
+    with open(dst, "wb") as f:
+        f.write(onx.SerializeToString())
+    print(f"Wrote {dst}")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:3])
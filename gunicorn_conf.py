@@ -0,0 +1,12 @@
+"""Gunicorn settings: gunicorn -c gunicorn_conf.py app:app"""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+worker_class = "gthread"
+workers = int(os.environ.get("WEB_CONCURRENCY", 4))
+threads = 8  # keep in line with DB_POOL_SIZE in app.py
+timeout = 120
+
+# Import the app (and load the model) once in the master before forking, so
+# workers start instantly and share the model's memory pages copy-on-write.
+preload_app = True